@@ -1,7 +1,14 @@
 import networkx as nx
+import numpy as np
 
 from networkx.generators import *
 
+# default attributes (in order of initialisation) of a new network, see network()
+_LINK_STATE_DEFAULTS = {"entangled": False, "age": 0}  # no entangled links present
+_USAGE_DEFAULTS = {"usage_count": 0, "usage_fraction": 0}
+_NODE_DEFAULTS = {"Qc": 1, **_LINK_STATE_DEFAULTS, **_USAGE_DEFAULTS}
+_EDGE_DEFAULTS = {"length": 1, "Qc": 1, "p_edge": 1, **_LINK_STATE_DEFAULTS}  # default edge length = 1km
+
 
 def network(n, m):
     """
@@ -11,10 +18,12 @@ def network(n, m):
     G    - Networkx graph G(V,E) which defines the topology of the network. see graphs.py for more details
     """
     G = nx.grid_2d_graph(n, m)  # n times m grid
-    nx.set_edge_attributes(G, 1, "length")  # default edge length = 1km
-    update_graph_params(G, p=1, Qc=1)  # initalise p,Qc as 1
-    reset_graph_state(G)  # initialise link-state of network (as no entangled links present)
-    reset_graph_usage(G)  # initialise usage params of network
+    # initalise length, p, Qc as 1, link-state (as no entangled links present) and usage params in one pass
+    for _, node in G.nodes(data=True):
+        node.update(_NODE_DEFAULTS)
+    for _, _, edge in G.edges(data=True):
+        edge.update(_EDGE_DEFAULTS)
+    init_graph_arrays(G)  # initialise array copy of link state used by run_entanglement_step
     return G
 
 
@@ -25,10 +34,16 @@ def reset_graph_state(G):
     Input Pararmeters:
     G         - Networkx graph G(V,E) which defines the topology of the network. see graphs.py for more details
     """
-    nx.set_edge_attributes(G, False, "entangled")
-    nx.set_node_attributes(G, False, "entangled")
-    nx.set_edge_attributes(G, 0, "age")
-    nx.set_node_attributes(G, 0, "age")
+    for _, _, edge in G.edges(data=True):  # one pass over edges and nodes
+        edge.update(_LINK_STATE_DEFAULTS)
+    for _, node in G.nodes(data=True):
+        node.update(_LINK_STATE_DEFAULTS)
+    arrays = getattr(G, "sim_arrays", None)
+    if arrays is not None:
+        for state in (arrays["edge_arrays"], arrays["node_arrays"]):
+            state["entangled"][:] = False
+            state["age"][:] = 0
+        arrays["entangled_view"].clear()
 
 
 def reset_graph_usage(G):
@@ -38,21 +53,28 @@ def reset_graph_usage(G):
     Input Pararmeters:
     G         - Networkx graph G(V,E) which defines the topology of the network. see graphs.py for more details
     """
-    nx.set_node_attributes(G, 0, "usage_count")
-    nx.set_node_attributes(G, 0, "usage_fraction")
+    for _, node in G.nodes(data=True):
+        node.update(_USAGE_DEFAULTS)
+    arrays = getattr(G, "sim_arrays", None)
+    if arrays is not None:
+        arrays["usage_count"][:] = 0
+        arrays["usage_fraction"][:] = 0
 
 
 def update_graph_usage(G, reps):
     """
     function to calculate and update usage_fraction from a given number of reps
+    usage_count is taken from the arrays of G (see init_graph_arrays), both are then written to the node dicts
 
     Input Pararmeters:
     G         - Networkx graph G(V,E) which defines the topology of the network. see graphs.py for more details
     reps - Total number of repetitions used to calculate usage fraction for each node (usage_count/reps)
     """
-    for node in G.nodes:
-        usage_count = G.nodes[node]["usage_count"]
-        G.nodes[node]["usage_fraction"] = usage_count / reps
+    arrays = get_graph_arrays(G)
+    arrays["usage_fraction"][:] = arrays["usage_count"] / reps
+    nodes = arrays["nodes"]
+    nx.set_node_attributes(G, dict(zip(nodes, arrays["usage_count"].tolist())), "usage_count")
+    nx.set_node_attributes(G, dict(zip(nodes, arrays["usage_fraction"].tolist())), "usage_fraction")
 
 
 def update_graph_params(G, p=None, Qc=None):
@@ -64,11 +86,18 @@ def update_graph_params(G, p=None, Qc=None):
     p  - edge link probability p, if inputted set all edges to have p_edge = p
     Qc - Decoherence time Qc, if inputted set all edges (and Nodes) to have decoherence time Qc
     """
+    arrays = getattr(G, "sim_arrays", None)
     if Qc is not None:
         nx.set_node_attributes(G, Qc, "Qc")
         nx.set_edge_attributes(G, Qc, "Qc")
+        if arrays is not None:
+            arrays["node_arrays"]["Qc"][:] = Qc
+            arrays["edge_arrays"]["Qc"][:] = Qc
+            arrays["homogeneous_qc"] = _homogeneous_qc(arrays)
     if p is not None:
         nx.set_edge_attributes(G, p, "p_edge")
+        if arrays is not None:
+            arrays["edge_arrays"]["p_edge"][:] = p
 
 
 def set_p_edge(G, p_op=0.8, loss_dB=None):
@@ -84,10 +113,13 @@ def set_p_edge(G, p_op=0.8, loss_dB=None):
     if loss_dB is None:
         update_graph_params(G, p=p_op)
     else:
-        for edge in G.edges:
-            length = G.edges[edge]["length"]
-            p_loss = 10 ** -(loss_dB * length / 10)
-            G.edges[edge]["p_edge"] = p_op * p_loss
+        edges = list(G.edges(data=True))
+        lengths = np.array([e["length"] for _, _, e in edges], dtype=float)
+        p_edges = p_op * 10 ** -(loss_dB * lengths / 10)  # p_loss for all edges at once
+        for (_, _, e), p_edge in zip(edges, p_edges.tolist()):
+            e["p_edge"] = p_edge
+        if getattr(G, "sim_arrays", None) is not None:
+            get_graph_arrays(G)["edge_arrays"]["p_edge"][:] = p_edges  # G.edges order is the array order
 
 
 def set_edge_length(G, length=1, p_op=0.8, loss_dB=0.2):
@@ -107,21 +139,302 @@ def set_edge_length(G, length=1, p_op=0.8, loss_dB=0.2):
 def get_entangled_subgraph(G):
     """
     Create a subgraph G' of G, G' includes all nodes in G, and all edges with successful entanglement links
-    Note G_prime is a deepcopy of data in G
+    G' is a read-only view of G (edge data is shared with G), restricted to the links entangled when it is created
+    Note the link state is first written back from the arrays of G (see init_graph_arrays)
 
     Input Pararmeters:
     G  - Networkx graph G(V,E) which defines the topology of the network. see graphs.py for more details
     Output Pararmeters:
     G_prime - subgraph G' where only edges with entangled links are kept
     """
-    G_prime = nx.Graph()
-    G_prime.add_nodes_from(G)
-    eligible_edges = [(u, v, e) for u, v, e in G.edges(data=True) if e["entangled"]]
-    G_prime.add_edges_from(eligible_edges)
+    arrays = get_graph_arrays(G)
+    sync_graph_state(G)
+    edges = arrays["edges"]
+    eligible_edges = [edges[i] for i in np.flatnonzero(arrays["edge_arrays"]["entangled"]).tolist()]
+    G_prime = nx.subgraph_view(G, filter_edge=nx.filters.show_edges(eligible_edges))
 
     return G_prime
 
 
+def init_graph_arrays(G):
+    """
+    function to build the structure-of-arrays copy of the link state (entangled, age) and link params (Qc, p_edge) of graph G,
+    so that run_entanglement_step can update every edge (and node) with a few vectorised numpy operations.
+    The arrays are stored as G.sim_arrays (not in G.graph, which must stay json serialisable for save_graph)
+
+    Input Pararmeters:
+    G  - Networkx graph G(V,E) which defines the topology of the network. see graphs.py for more details
+    Outputs:
+    arrays - dict with
+                edges / nodes           - list of edges / nodes of G, in array order
+                n_edges                 - number of edges of G when the arrays were built
+                edge_index / node_index - dict mapping edge (u, v) (and (v, u)) / node to its array index
+                edge_nodes              - array (number of edges x 2) of the node indices of the ends of each edge
+                edge_arrays             - dict of arrays "entangled" (bool), "age" (int32), "Qc" (float64), "p_edge" (float32)
+                node_arrays             - dict of arrays "entangled" (bool), "age" (int32), "Qc" (float64)
+                usage_count             - array of usage_count of each node (int64)
+                usage_fraction          - array of usage_fraction of each node (nan if not set)
+                homogeneous_qc          - Qc if all edges and nodes have the same Qc, else None
+                entangled_view          - EntangledView of the edges which are currently entangled
+    """
+    edges = list(G.edges(data=True))
+    nodes = list(G.nodes(data=True))
+    edge_index = {}
+    for i, (u, v, _) in enumerate(edges):
+        edge_index[u, v] = i
+        edge_index[v, u] = i
+
+    arrays = {
+        "edges": [(u, v) for u, v, _ in edges],
+        "n_edges": len(edges),
+        "nodes": [n for n, _ in nodes],
+        "edge_index": edge_index,
+        "node_index": {n: i for i, (n, _) in enumerate(nodes)},
+        "edge_arrays": {
+            "entangled": np.array([e["entangled"] for _, _, e in edges], dtype=bool),
+            "age": np.array([e["age"] for _, _, e in edges], dtype=np.int32),
+            "Qc": np.array([e["Qc"] for _, _, e in edges], dtype=float),
+            "p_edge": np.array([e["p_edge"] for _, _, e in edges], dtype=np.float32),
+        },
+        "node_arrays": {
+            "entangled": np.array([n["entangled"] for _, n in nodes], dtype=bool),
+            "age": np.array([n["age"] for _, n in nodes], dtype=np.int32),
+            "Qc": np.array([n["Qc"] for _, n in nodes], dtype=float),
+        },
+        "usage_count": np.array([n.get("usage_count", 0) for _, n in nodes], dtype=np.int64),
+        "usage_fraction": np.array(
+            [n.get("usage_fraction", np.nan) for _, n in nodes], dtype=float
+        ),
+    }
+    node_index = arrays["node_index"]
+    arrays["edge_nodes"] = np.array(
+        [(node_index[u], node_index[v]) for u, v in arrays["edges"]], dtype=np.int64
+    ).reshape(-1, 2)
+    arrays["homogeneous_qc"] = _homogeneous_qc(arrays)
+    arrays["entangled_view"] = EntangledView(
+        G, [(u, v) for u, v, e in edges if e["entangled"]]
+    )
+    G.sim_arrays = arrays
+    return arrays
+
+
+def _homogeneous_qc(arrays):
+    Qc = np.concatenate((arrays["edge_arrays"]["Qc"], arrays["node_arrays"]["Qc"]))
+    if len(Qc) == 0 or (Qc != Qc[0]).any():
+        return None
+    return Qc[0].item()
+
+
+def get_graph_arrays(G, check=True):
+    """
+    Returns the arrays of graph G (see init_graph_arrays), these are (re)built if missing or if the nodes / edges of G (or their
+    order) have changed.
+    Note params changed directly on the edge/node dicts (not via update_graph_params / set_p_edge) are reloaded at the start
+    of each protocol run (see refresh_graph_params)
+
+    Input Pararmeters:
+    G      - Networkx graph G(V,E) which defines the topology of the network. see graphs.py for more details
+    check  - (optional) if False only build the arrays if missing, skipping the comparison of the nodes / edges of G with those
+             of the arrays (O(E)), for use within a protocol run once the arrays have been checked
+    """
+    arrays = getattr(G, "sim_arrays", None)
+    if arrays is None:
+        arrays = init_graph_arrays(G)
+    elif check and (arrays["nodes"] != list(G) or arrays["edges"] != list(G.edges)):
+        arrays = init_graph_arrays(G)
+    return arrays
+
+
+def refresh_graph_params(G):
+    """
+    reload the params (Qc, p_edge) held in the arrays of graph G from its edge and node dicts, which hold the params of G
+    (e.g. set directly with nx.set_edge_attributes), only the link state is held by the arrays during a protocol run
+
+    Input Pararmeters:
+    G  - Networkx graph G(V,E) which defines the topology of the network. see graphs.py for more details
+    """
+    arrays = get_graph_arrays(G)
+    edge_arrays, node_arrays = arrays["edge_arrays"], arrays["node_arrays"]
+    adj, node_data = G._adj, G._node
+    edges = [adj[u][v] for u, v in arrays["edges"]]
+    edge_arrays["Qc"][:] = [e["Qc"] for e in edges]
+    edge_arrays["p_edge"][:] = [e["p_edge"] for e in edges]
+    node_arrays["Qc"][:] = [node_data[n]["Qc"] for n in arrays["nodes"]]
+    arrays["homogeneous_qc"] = _homogeneous_qc(arrays)
+
+
+def sync_graph_state(G):
+    """
+    write the link state (entangled, age) held in the arrays of graph G back into the edge and node dicts of G
+
+    Input Pararmeters:
+    G  - Networkx graph G(V,E) which defines the topology of the network. see graphs.py for more details
+    """
+    arrays = get_graph_arrays(G)
+    edge_arrays, node_arrays = arrays["edge_arrays"], arrays["node_arrays"]
+    adj, node_data = G._adj, G._node
+    for (u, v), entangled, age in zip(
+        arrays["edges"], edge_arrays["entangled"].tolist(), edge_arrays["age"].tolist()
+    ):
+        edge = adj[u][v]
+        edge["entangled"] = entangled
+        edge["age"] = age
+    for n, entangled, age in zip(
+        arrays["nodes"], node_arrays["entangled"].tolist(), node_arrays["age"].tolist()
+    ):
+        node = node_data[n]
+        node["entangled"] = entangled
+        node["age"] = age
+
+
+class EdgeAdjacency:
+    """
+    Adjacency of a subset of the edges of graph G (all nodes of G), which can be added / removed in place and searched
+    without building a new Networkx graph.
+    Paths are searched over neighbours in the same order as in a graph built from G.edges, so routing matches nx.shortest_path
+
+    Input Pararmeters:
+    G     - Networkx graph G(V,E) which defines the topology of the network. see graphs.py for more details
+    edges - (optional) iterable of edges (u, v) of G in the adjacency
+    """
+
+    def __init__(self, G, edges=()):
+        self.G = G
+        self.adj = {node: set() for node in G}
+        self.neighbours = {node: [] for node in G}  # neighbours in G, ordered as in a graph built from G.edges
+        for u, v in G.edges:
+            self.neighbours[u].append(v)
+            self.neighbours[v].append(u)
+        for u, v in edges:
+            self.add_edge(u, v)
+
+    def add_edge(self, u, v):
+        self.adj[u].add(v)
+        self.adj[v].add(u)
+
+    def remove_edge(self, u, v):
+        self.adj[u].discard(v)
+        self.adj[v].discard(u)
+
+    def remove_path(self, path):
+        """
+        Removes the edges between consecutive nodes of path, returns list of these edges
+        """
+        path_edges = list(zip(path[:-1], path[1:]))  # node - next_node pairs
+        for u, v in path_edges:
+            self.remove_edge(u, v)
+        return path_edges
+
+    def clear(self):
+        for neighbours in self.adj.values():
+            neighbours.clear()
+
+    def reachable(self, source, targets):
+        """
+        Returns set of targets connected to source by edges of the adjacency, single breadth first search stopping once all
+        are found
+        """
+        adj = self.adj
+        remaining = set(targets)
+        remaining.discard(source)
+        found = set(targets) - remaining
+        seen = {source}
+        frontier = [source]
+        while frontier and remaining:
+            next_frontier = []
+            for u in frontier:
+                for v in adj[u]:
+                    if v not in seen:
+                        seen.add(v)
+                        next_frontier.append(v)
+                        if v in remaining:
+                            remaining.discard(v)
+                            found.add(v)
+            frontier = next_frontier
+        return found
+
+    def shortest_path(self, source, target):
+        """
+        Returns list of nodes of a shortest path (fewest edges) from source to target, None if no path exists.
+        Bidirectional breadth first search (as nx.shortest_path) which picks the same path among equally short ones
+        """
+        if source == target:
+            return [source]
+        adj, neighbours = self.adj, self.neighbours
+        pred, succ = {source: None}, {target: None}
+        forward_fringe, reverse_fringe = [source], [target]
+        meet = None
+        while forward_fringe and reverse_fringe and meet is None:
+            if len(forward_fringe) <= len(reverse_fringe):
+                this_level, forward_fringe = forward_fringe, []
+                for u in this_level:
+                    links = adj[u]
+                    for v in neighbours[u]:
+                        if v not in links:
+                            continue
+                        if v not in pred:
+                            forward_fringe.append(v)
+                            pred[v] = u
+                        if v in succ:
+                            meet = v
+                            break
+                    if meet is not None:
+                        break
+            else:
+                this_level, reverse_fringe = reverse_fringe, []
+                for u in this_level:
+                    links = adj[u]
+                    for v in neighbours[u]:
+                        if v not in links:
+                            continue
+                        if v not in succ:
+                            succ[v] = u
+                            reverse_fringe.append(v)
+                        if v in pred:
+                            meet = v
+                            break
+                    if meet is not None:
+                        break
+        if meet is None:
+            return None
+
+        path = []
+        node = meet
+        while node is not None:
+            path.append(node)
+            node = pred[node]
+        path.reverse()
+        node = succ[meet]
+        while node is not None:
+            path.append(node)
+            node = succ[node]
+        return path
+
+    def subgraph(self, nodes):
+        """
+        Returns Networkx graph with given nodes and the edges of the adjacency between them (with edge data from G)
+        """
+        adj, neighbours, G_adj = self.adj, self.neighbours, self.G._adj
+        S = nx.Graph()
+        S.add_nodes_from(node for node in self.G if node in nodes)  # keep order of G
+        S.add_edges_from(
+            (u, v, G_adj[u][v]) for u in S for v in neighbours[u] if v in adj[u] and v in S
+        )
+        return S
+
+
+class EntangledView(EdgeAdjacency):
+    """
+    Adjacency of the entangled links of graph G (all nodes of G, only edges with an entangled link), used by the protocols
+    instead of building a new get_entangled_subgraph every timeslot. It is updated in place by run_entanglement_step as links
+    are generated / decohere and by _create_bell_pair as links are used (see EdgeAdjacency)
+
+    Input Pararmeters:
+    G     - Networkx graph G(V,E) which defines the topology of the network. see graphs.py for more details
+    edges - (optional) iterable of edges (u, v) of G which are entangled
+    """
+
+
 def update_usage_from_subgraph(G, J):
     """
     Updates usage parameters in G using the ones from subgraph J
@@ -133,6 +446,11 @@ def update_usage_from_subgraph(G, J):
     for node in J.nodes:
         G.nodes[node]["usage_count"] = J.nodes[node]["usage_count"]
         G.nodes[node]["usage_fraction"] = J.nodes[node]["usage_fraction"]
+    if getattr(G, "sim_arrays", None) is not None:
+        arrays, J_arrays = get_graph_arrays(G), get_graph_arrays(J)
+        indices = [arrays["node_index"][node] for node in J_arrays["nodes"]]
+        arrays["usage_count"][indices] = J_arrays["usage_count"]
+        arrays["usage_fraction"][indices] = J_arrays["usage_fraction"]
 
 
 def remove_nodes(G: nx.Graph, min_usage, excluded_nodes=None):
@@ -150,10 +468,15 @@ def remove_nodes(G: nx.Graph, min_usage, excluded_nodes=None):
     if excluded_nodes is None:
         excluded_nodes = []
 
-    count = 0
-    for node, usage in nx.get_node_attributes(G, "usage_fraction").items():
-        if (usage < min_usage) and (node not in excluded_nodes):
-            G.remove_node(node)
-            count += 1
+    nodes = list(G)
+    usage_fraction = np.fromiter(
+        (node.get("usage_fraction", np.nan) for _, node in G.nodes(data=True)), float, len(nodes)
+    )  # nan (never removed) if not set
+    excluded_nodes = set(excluded_nodes)
+    excluded_mask = np.fromiter((node in excluded_nodes for node in nodes), bool, len(nodes))
+
+    mask = (usage_fraction < min_usage) & ~excluded_mask
+    nodes_to_remove = [nodes[i] for i in np.flatnonzero(mask).tolist()]
+    G.remove_nodes_from(nodes_to_remove)
 
-    return count
+    return len(nodes_to_remove)
@@ -1,43 +1,60 @@
 import networkx as nx
-
-from simplequantnetsim.graph import network, reset_graph_state, update_graph_params
+import numpy as np
+
+from simplequantnetsim.graph import (
+    network,
+    reset_graph_state,
+    update_graph_params,
+    init_graph_arrays,
+)
 from networkx.generators import *
 from networkx.readwrite import json_graph
 import json
 import os
-import csv
+import pickle
 
 
-def save_graph(G, name="tree"):
+def save_graph(G, name="tree", fmt="pickle"):
     """
-    Save Networkx graph as json object in graphs folder
+    Save Networkx graph in graphs folder, as a pickle (.pkl) or optionally as a json object (.json) for use outside of python
 
     Input Pararmeters:
     G    - Networkx graph G(V,E) which defines the topology of the network. see graphs.py for more details
-    name - graph filename
+    name - graph filename (excluding directory or extension)
+    fmt  - (optional) "pickle" or "json"
     """
-    with open("graphs//" + name + ".json", "w") as outfile1:
-        outfile1.write(json.dumps(json_graph.node_link_data(G)))
+    if fmt == "json":
+        with open(os.path.join("graphs", name + ".json"), "w") as outfile1:
+            outfile1.write(json.dumps(json_graph.node_link_data(G)))
+    else:
+        with open(os.path.join("graphs", name + ".pkl"), "wb") as outfile1:
+            pickle.dump(
+                G.copy(), outfile1, protocol=pickle.HIGHEST_PROTOCOL
+            )  # copy without the arrays of G, these are rebuilt when needed (see get_graph_arrays)
 
 
 def load_graph(filename):
     """
-    load Networkx graph as json object in graphs folder
+    load Networkx graph saved by save_graph in graphs folder, from the .pkl file if it exists else from the .json file
 
     Input Pararmeters:
-    filesname - graph filename (.json file only) (name excluding directory or ".json")
+    filesname - graph filename (name excluding directory or extension)
 
     Outputs:
         G        - Networkx graph G(V,E) which defines the topology of the network. see graphs.py for more details
     """
-    with open("graphs//" + filename + ".json", "r") as f:
+    path = os.path.join("graphs", filename)
+    if os.path.exists(path + ".pkl"):
+        with open(path + ".pkl", "rb") as f:
+            return pickle.load(f)
+    with open(path + ".json", "r") as f:
         js_graph = json.loads(f.read())
     return json_graph.node_link_graph(js_graph)
 
 
 def make_graphs_list():
     """
-    create Networkx json graphs from .txt files in graphs folder
+    create (pickled) Networkx graphs from .txt files in graphs folder
     Note:
     Also create 6x6 grid graph
     initialise p and Qc as 1
@@ -70,22 +87,24 @@ def load_from_file(file="UKnet.txt"):  # could be done better?
     """
     current_directory = os.getcwd()
     graphs_dir = os.path.join(current_directory, "graphs")
-    title = True
-    data = []
-    with open(graphs_dir + "/" + file, encoding="ISO-8859-1") as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter="\t")
-        for row in csv_reader:
-            if title:
-                title = False
-            else:
-                data.append(
-                    (int(row[0]), int(row[1]), float(row[2]) / 100)
-                )  # note dividing km by 100 for the length
+    data = np.loadtxt(
+        os.path.join(graphs_dir, file),
+        delimiter="\t",
+        skiprows=1,  # title row
+        usecols=(0, 1, 2),
+        dtype=[("u", int), ("v", int), ("length", float)],
+        encoding="ISO-8859-1",
+        ndmin=1,
+    )
+    lengths = data["length"] / 100  # note dividing km by 100 for the length
     G = nx.Graph()
-    for x in data:
-        G.add_edge(str(x[0]), str(x[1]), length=x[2])
+    G.add_edges_from(
+        (str(u), str(v), {"length": length})
+        for u, v, length in zip(data["u"].tolist(), data["v"].tolist(), lengths.tolist())
+    )
     update_graph_params(G, p=1, Qc=1)  # default p,Qc as 1
     reset_graph_state(G)  # initalise link data
+    init_graph_arrays(G)  # initalise array copy of link data
     return G
 
 
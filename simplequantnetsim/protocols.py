@@ -6,14 +6,27 @@ from simplequantnetsim.graph import (
     update_graph_usage,
     update_usage_from_subgraph,
     reset_graph_state,
-    get_entangled_subgraph,
+    get_graph_arrays,
+    refresh_graph_params,
+    sync_graph_state,
+    EdgeAdjacency,
+)
+from simplequantnetsim.sim import (
+    run_entanglement_step,
+    random_numbers,
+    init_used_nodes,
+    component_labels,
 )
-from simplequantnetsim.sim import run_entanglement_step
 
 from networkx.algorithms.approximation.steinertree import steiner_tree
 
+try:  # optional, used to run reps in parallel (n_jobs)
+    from joblib import Parallel, delayed, effective_n_jobs
+except ImportError:
+    Parallel = None
+
 
-def SP_protocol(G, users, timesteps, reps, count_fusion=False):
+def SP_protocol(G, users, timesteps, reps, count_fusion=False, n_jobs=None, seed=None):
     """
     Shortest Path protocol taken from [SPsource] The protocol attempts to generate bell pairs between a central node and a set of users.
     This is done by attmepting entanglement along a set of edge disjoint paths, all connected to the centre node. The protocol
@@ -25,6 +38,8 @@ def SP_protocol(G, users, timesteps, reps, count_fusion=False):
     users     - List of nodes in G which between which a GHZ should be shared. users[0] is the centre of the star which should be calculated before sending to SP_protocol
     timesteps - number of timesteps the protocol will run for before terminating without a successful GHZ generation,
     reps      - number of repetions the protocol will run for the imput parameters to generate a dataset.
+    n_jobs    - (optional) number of processes the reps are run on (joblib, -1 for all cores), run serially if None or joblib not installed
+    seed      - (optional) seed for the random number generators of the reps, if None it is drawn from np.random
 
     Outputs:
     rate                   -  entanglement rate (ER) (average GHZs generated per timeslot)
@@ -36,13 +51,21 @@ def SP_protocol(G, users, timesteps, reps, count_fusion=False):
     )  # get the shortest star in G, which connects all destination_nodes to the source_node
 
     er, multipartite_gen_time, avg_links_used = _run_protocol(
-        J, users, timesteps, reps, _SD_protocol, nodes=True, count_fusion=count_fusion
+        J,
+        users,
+        timesteps,
+        reps,
+        _SD_protocol,
+        nodes=True,
+        count_fusion=count_fusion,
+        n_jobs=n_jobs,
+        seed=seed,
     )
     update_usage_from_subgraph(G, J)
     return er, multipartite_gen_time, avg_links_used
 
 
-def MPG_protocol(G, users, timesteps, reps, count_fusion=False):
+def MPG_protocol(G, users, timesteps, reps, count_fusion=False, n_jobs=None, seed=None):
     """
     Multipath protocol - Greedy. Protoocol attempts shortest path routing between centre node and each other user seqentially to generate N bell pairs (1 shared between centre and each of N users). The protocol terminates once bell pairs is shared as this is sufficent for generating a GHZ.
 
@@ -51,6 +74,8 @@ def MPG_protocol(G, users, timesteps, reps, count_fusion=False):
     users     - List of nodes in G that must share a GHZ state.  users[0] is the centre of the star which should be calculated before sending to SP_protocol
     timesteps - number of timesteps the protocol will run for before terminating without a successful GHZ generation,
     reps      - number of repetions the protocol will run for the imput parameters to generate a dataset.
+    n_jobs    - (optional) number of processes the reps are run on (joblib, -1 for all cores), run serially if None or joblib not installed
+    seed      - (optional) seed for the random number generators of the reps, if None it is drawn from np.random
 
     Outputs:
     rate                   -  entanglement rate (ER) (average GHZs generated per timeslot)
@@ -58,11 +83,19 @@ def MPG_protocol(G, users, timesteps, reps, count_fusion=False):
     avg_links_used         -  number of entanglement links used per repetition for successful GHZ generation
     """
     return _run_protocol(
-        G, users, timesteps, reps, _SD_protocol, nodes=True, count_fusion=count_fusion
+        G,
+        users,
+        timesteps,
+        reps,
+        _SD_protocol,
+        nodes=True,
+        count_fusion=count_fusion,
+        n_jobs=n_jobs,
+        seed=seed,
     )
 
 
-def MPC_protocol(G, users, timesteps, reps, count_fusion=False):
+def MPC_protocol(G, users, timesteps, reps, count_fusion=False, n_jobs=None, seed=None):
     """
     Multipath protocol - Cooperative. Entanglement is attempted along all edges for input graph. If all users are in the same CC of nodes connected by links, this is sufficent for a GHZ state and protocol is assumed successful
 
@@ -71,93 +104,156 @@ def MPC_protocol(G, users, timesteps, reps, count_fusion=False):
     users     - List of nodes in G that must share a GHZ state
     timesteps - number of timesteps the protocol will run for before terminating without a successful GHZ generation,
     reps      - number of repetions the protocol will run for to attempt to distribute a GHZ state before recording a failure (i.e. if all p=0).
+    n_jobs    - (optional) number of processes the reps are run on (joblib, -1 for all cores), run serially if None or joblib not installed
+    seed      - (optional) seed for the random number generators of the reps, if None it is drawn from np.random
 
     Outputs:
     rate                   -  entanglement rate (ER)) (average GHZs generated per timeslot)
     multipartite_gen_time  -  array (length of reps)  results ER in GHZ/tslot where tslot is number of timesteps, if no successful GHZ generated value is -1
     avg_links_used         -  number of entanglement links used per repetition for successful GHZ generation
     """
-    return _run_protocol(G, users, timesteps, reps, _CC_protocol, count_fusion=count_fusion)
+    return _run_protocol(
+        G, users, timesteps, reps, _CC_protocol, count_fusion=count_fusion, n_jobs=n_jobs, seed=seed
+    )
 
 
-def _run_protocol(G, users, timesteps, reps, success_protocol, nodes=False, count_fusion=False):
+def _run_protocol(
+    G, users, timesteps, reps, success_protocol, nodes=False, count_fusion=False, n_jobs=None, seed=None
+):
     reset_graph_usage(G)
-    multipartite_gen_time = -1 * np.ones((reps))
-    links_used = 0
-    for i in range(reps):
-        reset_graph_state(G)
-        used_nodes = []
-        t = 0
-        while t < timesteps and multipartite_gen_time[i] == -1:  # for t timesteps or until success
-            t += 1
-            run_entanglement_step(G, used_nodes, nodes)  # SP and MPG require nodes True
-            H = get_entangled_subgraph(G)
-            success = success_protocol(G, H, users, used_nodes, count_fusion)  # protocol specific
-            if success:
-                # do fusion (assumed ideal)
-                multipartite_gen_time[i] = t
-                # add usage & used links
-                for path in used_nodes:
-                    links_used += path["edge_count"]
-                    for n in path["nodes"]:
-                        G.nodes[n]["usage_count"] += 1
+    refresh_graph_params(G)  # checks the arrays of G, Qc / p_edge may have been set directly on the edge / node dicts
+    if seed is None:
+        seed = np.random.randint(2**32, dtype=np.uint64)  # so np.random.seed still makes runs reproducible
+    rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(reps)]
+    args = (users, timesteps, success_protocol, nodes, count_fusion)
+
+    if n_jobs is None or Parallel is None or effective_n_jobs(n_jobs) == 1:
+        results = _run_reps(G, *args, rngs)
+    else:  # each worker gets a copy of G and a chunk of the reps
+        chunks = np.array_split(np.arange(reps), min(effective_n_jobs(n_jobs), reps))
+        chunk_results = Parallel(n_jobs=n_jobs, backend="loky")(
+            delayed(_run_reps)(G, *args, [rngs[i] for i in chunk]) for chunk in chunks
+        )
+        results = [result for chunk_result in chunk_results for result in chunk_result]
+
+    gen_times, links, usage_count_deltas = zip(*results)
+    multipartite_gen_time = np.array(gen_times, dtype=float)
+    links_used = sum(links)
+    get_graph_arrays(G)["usage_count"][:] += np.sum(usage_count_deltas, axis=0)
+
+    sync_graph_state(G)  # write final link state back to edge / node dicts
     rate = _multipartite_rate(multipartite_gen_time, timesteps)
     update_graph_usage(G, reps)
     avg_links_used = links_used / reps
     return rate, multipartite_gen_time, avg_links_used
 
 
-# for MPC
-def _CC_protocol(G, H, users, used_nodes, count_fusion=False):
-    CC = nx.node_connected_component(H, users[0])
-
-    # can check a set is within a set with operators
-    if not (set(users) <= CC):
-        return False  # unsuccessful, all users not in same connected component which is needed for tree between them to exist
-
-    K = steiner_tree(
-        H.subgraph(CC), users, weight="length"
-    )  # calculate Steiner tree connecting users
+def _run_reps(G, users, timesteps, success_protocol, nodes, count_fusion, rngs):
+    steiner_memo = {}  # Steiner trees calculated by _CC_protocol, shared by the reps
+    return [
+        _single_rep(G, users, timesteps, success_protocol, nodes, count_fusion, rng, steiner_memo)
+        for rng in rngs
+    ]
 
-    # only nodes that perform entanglement swapping (2 edges) and (optionally) fusion (3 edges or user with 2 edges) is recorded as used
-    used_nodes.append(
-        {
-            "nodes": [node for node in K.nodes if _count_node(K, node, users, count_fusion)],
-            "edge_count": K.number_of_edges(),
-        }
-    )
 
-    return True
+def _single_rep(G, users, timesteps, success_protocol, nodes, count_fusion, rng, steiner_memo):
+    """
+    run a single repetition of a protocol, for timesteps or until a GHZ state is generated
 
+    Outputs:
+    gen_time          - timesteps until successful GHZ generated, -1 if no successful GHZ generated
+    links_used        - number of entanglement links used for successful GHZ generation
+    usage_count_delta - array of usage count added to each node (in array order of G)
+    """
+    reset_graph_state(G)
+    arrays = get_graph_arrays(G, check=False)  # checked once per run by refresh_graph_params
+    H = arrays["entangled_view"]  # updated in place by run_entanglement_step
+    usage_count_delta = np.zeros(len(arrays["nodes"]), dtype=np.int64)
+    used_nodes = init_used_nodes()
+    # protocol state of the repetition: indices of the links generated in the last timestep and (for _CC_protocol) the
+    # mask of the connected component of its last unsuccessful check and the Steiner trees of the run
+    rep_state = {"added": None, "checked_component": None, "steiner_memo": steiner_memo}
+    r_lists = random_numbers(rng, timesteps, arrays["n_edges"])
+    for t, r_list in enumerate(r_lists, start=1):  # for t timesteps or until success
+        rep_state["added"] = run_entanglement_step(
+            G, used_nodes, nodes, r_list=r_list
+        )  # SP and MPG require nodes True
+        success = success_protocol(G, H, users, used_nodes, rep_state, count_fusion)  # protocol specific
+        if success:
+            # do fusion (assumed ideal)
+            # add usage & used links
+            links_used = sum(used_nodes["edge_count"])
+            node_indices = [i for path_nodes in used_nodes["nodes"] for i in path_nodes]
+            np.add.at(usage_count_delta, np.array(node_indices, dtype=int), 1)
+            return t, links_used, usage_count_delta
+    return -1, 0, usage_count_delta
+
+
+_STEINER_MEMO_SIZE = 128  # Steiner trees kept per run by _CC_protocol
 
-def _count_node(K, node, users, count_fusion=False):
-    count_node = False
 
-    # entanglement swapping
-    if K.degree(node) == 2:
-        # if node is a user then it performs fusion
-        if (node not in users) or count_fusion:
-            count_node = True
+# for MPC
+def _CC_protocol(G, H, users, used_nodes, rep_state, count_fusion=False):
+    arrays = get_graph_arrays(G, check=False)
+    node_index = arrays["node_index"]
+    checked_CC = rep_state["checked_component"]
+    if checked_CC is not None and not checked_CC[arrays["edge_nodes"][rep_state["added"]]].any():
+        return False  # no new link touches the CC of the last check, so the CC can only have shrunk since then
+
+    labels = component_labels(G)  # union-find over the entangled links
+    CC = labels == labels[node_index[users[0]]]  # mask of the nodes connected to users[0]
+
+    if not CC[[node_index[user] for user in users]].all():
+        rep_state["checked_component"] = CC
+        return False  # unsuccessful, all users not in same connected component which is needed for tree between them to exist
 
-    # fusion
-    elif K.degree(node) > 2 and count_fusion:
-        count_node = True
+    # the same links give the same subgraph (and tree) within a run, so the used nodes / links are kept by entangled links
+    steiner_memo = rep_state["steiner_memo"]
+    key = arrays["edge_arrays"]["entangled"].tobytes()
+    if key not in steiner_memo:
+        S = H.subgraph({node for node, connected in zip(arrays["nodes"], CC.tolist()) if connected})
+        K = steiner_tree(S, users, weight="length")  # calculate Steiner tree connecting users
+
+        # only nodes that perform entanglement swapping (2 edges) and (optionally) fusion (3 edges or user with 2 edges) is recorded as used
+        # (a user with 2 edges performs fusion)
+        users_set = frozenset(users)
+        if len(steiner_memo) >= _STEINER_MEMO_SIZE:
+            del steiner_memo[next(iter(steiner_memo))]  # drop the oldest tree
+        steiner_memo[key] = (
+            tuple(
+                node_index[node]
+                for node, degree in K.degree()
+                if (degree == 2 and (count_fusion or node not in users_set))
+                or (degree > 2 and count_fusion)
+            ),
+            K.number_of_edges(),
+        )
+    path_nodes, edge_count = steiner_memo[key]
+    used_nodes["nodes"].append(path_nodes)
+    used_nodes["age"].append(0)
+    used_nodes["destination_node"].append(-1)
+    used_nodes["edge_count"].append(edge_count)
 
-    return count_node
+    return True
 
 
 # for SP and MPG
-def _SD_protocol(G, H, users, used_nodes, count_fusion=False):
+def _SD_protocol(G, H, users, used_nodes, rep_state, count_fusion=False):
     source_node = users[0]
     destination_nodes = users[1:]
+    arrays = get_graph_arrays(G, check=False)
+    node_entangled, node_index = arrays["node_arrays"]["entangled"], arrays["node_index"]
 
-    for destination_node in destination_nodes:
-        if not G.nodes[destination_node]["entangled"] and nx.has_path(
-            H, source_node, destination_node
-        ):
-            path = nx.shortest_path(H, source_node, destination_node)
-            _create_bell_pair(G, H, path, used_nodes)
-    return all([G.nodes[x]["entangled"] for x in destination_nodes])
+    waiting_nodes = [x for x in destination_nodes if not node_entangled[node_index[x]]]
+    if waiting_nodes:
+        # one search for all destinations, links are only used up below so unreachable destinations stay unreachable
+        reachable_nodes = H.reachable(source_node, waiting_nodes)
+        for destination_node in waiting_nodes:
+            if destination_node in reachable_nodes:
+                path = H.shortest_path(source_node, destination_node)
+                if path is not None:
+                    _create_bell_pair(G, H, path, used_nodes)
+    return all([node_entangled[node_index[x]] for x in destination_nodes])
 
 
 def _create_bell_pair(G, H, path, used_nodes):
@@ -166,24 +262,27 @@ def _create_bell_pair(G, H, path, used_nodes):
 
     Inputs:
     G                - Networkx graph G(V,E') which defines the topology of the graph (or subgraph which entanglement is attempted on).
-    H                - Networkx graph G'(V,E') which defines the topology of the links.
+    H                - EntangledView of G which defines the topology of the links still available, the path's links are removed from it
     route            - path of nodes selected to perform entanglement swapping between route[0]=source route[-1] = destination
-    used_nodes       - list of paths of the nodes that performed entanglement swapping to be updated
+    used_nodes       - paths of the nodes that performed entanglement swapping to be updated (see init_used_nodes)
 
     """
-    for u, v in zip(path[:-1], path[1:]):  # node - next_node pairs
-        H.remove_edge(u, v)
-        edge = G.edges[u, v]
-        edge["entangled"] = False
-        edge["age"] = 0
-
-    destination_node = G.nodes[path[-1]]
-    destination_node["entangled"] = True
-    destination_node["age"] = 0
-
-    used_nodes.append(
-        {"nodes": path[1:-1], "age": 0, "destination_node": path[-1], "edge_count": len(path) - 1}
-    )
+    arrays = get_graph_arrays(G, check=False)
+    edge_arrays, node_arrays = arrays["edge_arrays"], arrays["node_arrays"]
+    edge_index = arrays["edge_index"]
+    indices = [edge_index[edge] for edge in H.remove_path(path)]  # links used up by swapping
+    edge_arrays["entangled"][indices] = False
+    edge_arrays["age"][indices] = 0
+
+    node_index = arrays["node_index"]
+    i = node_index[path[-1]]
+    node_arrays["entangled"][i] = True
+    node_arrays["age"][i] = 0
+
+    used_nodes["nodes"].append([node_index[node] for node in path[1:-1]])
+    used_nodes["age"].append(0)
+    used_nodes["destination_node"].append(i)
+    used_nodes["edge_count"].append(len(path) - 1)
 
 
 def _multipartite_rate(gen_times, max_timesteps):
@@ -225,28 +324,24 @@ def _get_star(G, users):
     # NON optimal good enough for grids with corner users
     source_node = users[0]
     destination_nodes = users[1:]
-    # copy G twice H for calculation and J for reduced graph
-    T = G.__class__()
-    T.add_nodes_from(G.nodes(data=True))
-    T.add_edges_from(G.edges(data=True))
-    # Graph H is a deepcopy of G, if an edge is added to J it is removed from H, routing is then performed over H. This enforces edge disjoint routing
-    J = G.__class__()
-    J.add_nodes_from(G.nodes(data=True))  # Graph J with nodes from G and no edges (yet!)
+    # T holds the edges of G not yet used by the star, routing is performed over T. This enforces edge disjoint routing
+    # (no copy of G, T is an adjacency of all edges of G, see EdgeAdjacency)
+    T = EdgeAdjacency(G, G.edges)
+    J_edges = []  # edges of the star, in the order they are found
     edge_disjoint = True  # G.degree[source_node]>= len(destination_nodes) # can it be edge disjoint
     for destination_node in destination_nodes:
-        if nx.has_path(T, source_node, destination_node):
-            path = nx.shortest_path(T, source_node, destination_node)
-            for u, v in zip(path[:-1], path[1:]):  # node- next_node pairs
-                T.remove_edge(u, v)  # remove path from H
-                J.add_edge(u, v)  # add edge to new graph J
+        path = T.shortest_path(source_node, destination_node)
+        if path is not None:
+            J_edges.extend(T.remove_path(path))  # remove path from T
         else:
             edge_disjoint = False  # unused flag to say if J is edge_disjoint
             path = nx.shortest_path(G, source_node, destination_node)
-            for u, v in zip(path[:-1], path[1:]):
-                J.add_edge(u, v)  # add edge to new graph J
-                if T.has_edge(u, v):
-                    T.remove_edge(u, v)  # remove path from H
-    [
-        J[u][v].update(G.get_edge_data(u, v)) for (u, v) in J.edges()
-    ]  # add edge data to edge in J from G
+            J_edges.extend(T.remove_path(path))  # remove path from T (if still there)
+
+    # J is built in one pass with all nodes of G (so usage of unused nodes is reset by update_usage_from_subgraph) and the star
+    # edges in the order they were found, with edge data read directly from the adjacency of G
+    G_adj = G._adj
+    J = G.__class__()
+    J.add_nodes_from(G.nodes(data=True))
+    J.add_edges_from((u, v, G_adj[u][v]) for u, v in J_edges)
     return J
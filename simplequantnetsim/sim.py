@@ -1,48 +1,264 @@
 import numpy as np
 
+from simplequantnetsim.graph import get_graph_arrays
 
-def run_entanglement_step(G, used_nodes, nodes=False):
+try:  # optional, compiles the link / node update of a timestep into a single loop
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def run_entanglement_step(G, used_nodes, nodes=False, rng=None, r_list=None):
     """
     simulate the link generation and decoherence for a single timeslot (step)
+    all edges (and nodes) are updated at once using the arrays of G (see init_graph_arrays), links which are generated /
+    decohere are then added to / removed from the EntangledView of G
+    the update is a single compiled loop if numba is installed, else a few vectorised numpy operations
 
     Input Pararmeters:
     G          - Networkx graph G(V,E) which defines the topology of the network. see graphs.py for more details
-    used_nodes - List of paths of used nodes (only updated if nodes parameter is True)
+    used_nodes - paths of used nodes, see init_used_nodes (only updated if nodes parameter is True)
     nodes      - (optional) include simulating "node" entanglement in model
+    rng        - (optional) numpy Generator used for the random numbers, np.random if None
+    r_list     - (optional) array of random numbers between 0 and 1 (size of number of edges) to use instead of drawing them
+
+    Outputs:
+    added      - array of indices (see init_graph_arrays) of the edges whose link was generated in this timeslot
     """
-    r_list = np.random.rand(
-        len(G.edges())
-    )  # array of random numbers between 0 and 1 (size of number of edges)
-    for edge, r in zip(G.edges().values(), r_list):
-        if edge["entangled"]:  #  if entangled edge exists inc age
-            edge["age"] += 1
-
-            if (
-                edge["age"] >= edge["Qc"]
-            ):  # If the edge is now too old then discard it - only required for entangled edges
-                edge["entangled"] = False
-                edge["age"] = 0
-
-        if (
-            not edge["entangled"] and edge["p_edge"] > r
-        ):  # greater is correct (hint p_edge = 0, rand =  0) and (hint p_edge = 1, rand =  0.999...)
-            edge["entangled"] = True
-            edge["age"] = 0
-
-    if nodes:
-        for node_name in G.nodes():
-            node = G.nodes[node_name]
-
-            if node["entangled"]:
-                node["age"] += 1
-
-            if node["age"] >= node["Qc"]:
-                node["entangled"] = False
-                edge["age"] = 0
-
-        for path in used_nodes:
-            path["age"] += 1
-
-        used_nodes[:] = [
-            path for path in used_nodes if path["age"] < G.nodes[path["destination_node"]]["Qc"]
+    arrays = get_graph_arrays(G, check=False)  # checked once per repetition, not every timestep
+    edge_arrays = arrays["edge_arrays"]
+    entangled, age = edge_arrays["entangled"], edge_arrays["age"]
+
+    if r_list is None:
+        r_list = (np.random if rng is None else rng).random(
+            arrays["n_edges"]
+        )  # array of random numbers between 0 and 1 (size of number of edges)
+
+    qc1 = arrays["homogeneous_qc"] == 1  # every link decoheres after one timeslot, so no ages to track
+    if qc1:
+        added, removed = _update_links_qc1(entangled, edge_arrays["p_edge"], r_list)
+    else:
+        added, removed = _update_links(
+            entangled, age, edge_arrays["Qc"], edge_arrays["p_edge"], r_list
+        )
+
+    edges, entangled_view = arrays["edges"], arrays["entangled_view"]
+    for i in removed.tolist():
+        entangled_view.remove_edge(*edges[i])
+    for i in added.tolist():
+        entangled_view.add_edge(*edges[i])
+
+    if nodes and qc1:  # all node links and paths expire
+        arrays["node_arrays"]["entangled"][:] = False
+        for field in used_nodes.values():
+            field.clear()
+    elif nodes:
+        node_arrays = arrays["node_arrays"]
+        node_Qc = node_arrays["Qc"]
+        _update_nodes(node_arrays["entangled"], node_arrays["age"], node_Qc)
+
+        # age paths and keep those whose destination link is still alive
+        ages = [age + 1 for age in used_nodes["age"]]
+        used_nodes["age"] = ages
+        keep = [
+            age < Qc for age, Qc in zip(ages, node_Qc[used_nodes["destination_node"]].tolist())
         ]
+        if not all(keep):
+            for key, field in used_nodes.items():
+                used_nodes[key] = [value for value, kept in zip(field, keep) if kept]
+
+    return added
+
+
+def init_used_nodes():
+    """
+    Returns empty record of the paths used in a repetition, as a dict of lists with one entry per path:
+        nodes            - list of array indices (see init_graph_arrays) of the nodes that performed entanglement swapping (/fusion)
+        age              - age of the path (timeslots)
+        destination_node - array index of the destination node of the path (-1 if none)
+        edge_count       - number of links used by the path
+    """
+    return {"nodes": [], "age": [], "destination_node": [], "edge_count": []}
+
+
+def _update_links_numpy(entangled, age, Qc, p_edge, r_list):
+    """
+    age / decohere / generate the links of all edges in place (arrays of G, see init_graph_arrays)
+
+    Outputs:
+    added   - array of indices of edges that are newly entangled
+    removed - array of indices of edges that are no longer entangled
+    """
+    was_entangled = entangled.copy()
+
+    age += entangled  # if entangled edge exists inc age
+    expired = entangled & (
+        age >= Qc
+    )  # If the edge is now too old then discard it - only required for entangled edges
+    entangled &= ~expired
+    age[expired] = 0
+
+    new = ~entangled & (
+        p_edge > r_list
+    )  # greater is correct (hint p_edge = 0, rand =  0) and (hint p_edge = 1, rand =  0.999...)
+    entangled |= new
+    age[new] = 0
+
+    return np.flatnonzero(entangled & ~was_entangled), np.flatnonzero(was_entangled & ~entangled)
+
+
+def _update_links_loop(entangled, age, Qc, p_edge, r_list):
+    # same as _update_links_numpy as a single loop over the edges, for numba
+    added = np.empty(len(entangled), dtype=np.int64)
+    removed = np.empty(len(entangled), dtype=np.int64)
+    n_added = 0
+    n_removed = 0
+    for i in range(len(entangled)):
+        was_entangled = entangled[i]
+        if was_entangled:
+            age[i] += 1
+            if age[i] >= Qc[i]:
+                entangled[i] = False
+                age[i] = 0
+        if not entangled[i] and p_edge[i] > r_list[i]:
+            entangled[i] = True
+            age[i] = 0
+        if was_entangled and not entangled[i]:
+            removed[n_removed] = i
+            n_removed += 1
+        elif entangled[i] and not was_entangled:
+            added[n_added] = i
+            n_added += 1
+    return added[:n_added], removed[:n_removed]
+
+
+def _update_links_qc1_numpy(entangled, p_edge, r_list):
+    """
+    _update_links_numpy for Qc = 1 on all edges, every link decoheres so the new link state is p_edge > r_list (ages stay 0)
+    """
+    was_entangled = entangled.copy()
+    np.greater(p_edge, r_list, out=entangled)
+    return np.flatnonzero(entangled & ~was_entangled), np.flatnonzero(was_entangled & ~entangled)
+
+
+def _update_links_qc1_loop(entangled, p_edge, r_list):
+    # same as _update_links_qc1_numpy as a single loop over the edges, for numba
+    added = np.empty(len(entangled), dtype=np.int64)
+    removed = np.empty(len(entangled), dtype=np.int64)
+    n_added = 0
+    n_removed = 0
+    for i in range(len(entangled)):
+        was_entangled = entangled[i]
+        entangled[i] = p_edge[i] > r_list[i]
+        if was_entangled and not entangled[i]:
+            removed[n_removed] = i
+            n_removed += 1
+        elif entangled[i] and not was_entangled:
+            added[n_added] = i
+            n_added += 1
+    return added[:n_added], removed[:n_removed]
+
+
+def _update_nodes_numpy(entangled, age, Qc):
+    """
+    age / decohere the links stored at the nodes in place (arrays of G, see init_graph_arrays)
+    """
+    age += entangled
+    expired = entangled & (age >= Qc)
+    entangled &= ~expired
+    age[expired] = 0
+
+
+def _update_nodes_loop(entangled, age, Qc):
+    # same as _update_nodes_numpy as a single loop over the nodes, for numba
+    for i in range(len(entangled)):
+        if entangled[i]:
+            age[i] += 1
+            if age[i] >= Qc[i]:
+                entangled[i] = False
+                age[i] = 0
+
+
+def _component_labels_numpy(edge_nodes, entangled, n_nodes):
+    """
+    label the connected components of the entangled edges by propagating the smallest node index along the links
+    (with pointer jumping) until no label changes
+
+    Outputs:
+    labels - array of the label of each node (array order), nodes are connected iff they have the same label
+    """
+    u, v = edge_nodes[entangled].T
+    labels = np.arange(n_nodes)
+    while True:
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, u, labels[v])
+        np.minimum.at(new_labels, v, labels[u])
+        new_labels = new_labels[new_labels]
+        if (new_labels == labels).all():
+            return labels
+        labels = new_labels
+
+
+def _component_labels_loop(edge_nodes, entangled, n_nodes):
+    # same as _component_labels_numpy as a union-find over the edges, for numba (labels are the roots)
+    parent = np.arange(n_nodes)
+    for i in range(len(entangled)):
+        if entangled[i]:
+            u = edge_nodes[i, 0]
+            while parent[u] != u:
+                parent[u] = parent[parent[u]]
+                u = parent[u]
+            v = edge_nodes[i, 1]
+            while parent[v] != v:
+                parent[v] = parent[parent[v]]
+                v = parent[v]
+            if u != v:
+                parent[max(u, v)] = min(u, v)
+    for i in range(n_nodes):
+        parent[i] = parent[parent[i]]  # parents have smaller index so are already roots
+    return parent
+
+
+if njit is not None:
+    _update_links = njit(cache=True)(_update_links_loop)
+    _update_links_qc1 = njit(cache=True)(_update_links_qc1_loop)
+    _update_nodes = njit(cache=True)(_update_nodes_loop)
+    _component_labels = njit(cache=True)(_component_labels_loop)
+else:
+    _update_links = _update_links_numpy
+    _update_links_qc1 = _update_links_qc1_numpy
+    _update_nodes = _update_nodes_numpy
+    _component_labels = _component_labels_numpy
+
+
+def component_labels(G):
+    """
+    Returns array labelling the connected components of the entangled links of G (see init_graph_arrays), nodes
+    (in array order) are connected by entangled links iff they have the same label
+
+    Input Pararmeters:
+    G - Networkx graph G(V,E) which defines the topology of the network. see graphs.py for more details
+    """
+    arrays = get_graph_arrays(G, check=False)
+    return _component_labels(
+        arrays["edge_nodes"], arrays["edge_arrays"]["entangled"], len(arrays["nodes"])
+    )
+
+
+def random_numbers(rng, timesteps, n_edges, max_block=256):
+    """
+    yield the random numbers for run_entanglement_step for each timestep, drawn (as float32) in blocks of timesteps that double
+    in size up to max_block, so few draws are wasted if the protocol succeeds early
+
+    Input Pararmeters:
+    rng       - numpy Generator used for the random numbers
+    timesteps - maximum number of timesteps
+    n_edges   - number of edges (random numbers per timestep)
+    max_block - maximum number of timesteps drawn at once
+    """
+    t, block_size = 0, 1
+    while t < timesteps:
+        block = rng.random((min(block_size, timesteps - t), n_edges), dtype=np.float32)
+        yield from block
+        t += len(block)
+        block_size = min(2 * block_size, max_block)